@@ -0,0 +1,228 @@
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from pkg_resources import parse_version
+import pytest
+from vr.common.paths import get_container_path, get_proc_path
+
+from vr.runners import api, base, image
+
+
+@pytest.fixture()
+def config():
+    return {
+        'app_name': 'apiApp',
+        'proc_name': 'web',
+        'port': 2345,
+        'release_hash': 'deadbeef',
+        'version': '1.0',
+        'config_name': 'config-name',
+        'image_name': 'image-name',
+        'cmd': 'command',
+        'host': 'localhost',
+    }
+
+
+def make_tarball(filename, content):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tf:
+        info = tarfile.TarInfo(filename)
+        info.size = len(content)
+        tf.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+@pytest.fixture()
+def artifact_server():
+    """
+    Serve tarballs from a dict of url -> bytes in place of requests.get.
+    """
+    tarballs = {}
+
+    def get(url, stream=False):
+        return Mock(raw=io.BytesIO(tarballs[url]))
+
+    with patch('vr.runners.base.requests.get', Mock(side_effect=get)) as get_:
+        get_.tarballs = tarballs
+        yield get_
+
+
+class StubImageRunner(image.ImageRunner):
+    ensure_image = Mock()
+    ensure_container = Mock()
+    ensure_char_devices = Mock()
+
+
+@patch('vr.runners.image.get_lxc_version',
+       Mock(return_value=parse_version('1.0.8')))
+class TestAPI(object):
+
+    def test_setup_and_teardown(self, config, capsys):
+        result = api.setup(config, runner_class=StubImageRunner)
+        assert result.command == 'setup'
+        assert result.container_name == (
+            'apiApp-1.0-config-name-deadbeef-web-2345')
+        assert 'Writing proc.sh' in result.output
+        assert result.elapsed >= 0
+        runner = api.get_runner(config)
+        p = get_container_path(runner.config)
+        assert os.path.exists(os.path.join(p, 'proc.sh'))
+        assert capsys.readouterr().out == ''
+
+        api.teardown(config, runner_class=StubImageRunner)
+        assert not os.path.exists(get_proc_path(runner.config))
+
+    def test_locked(self, config):
+        locks = api.ContainerLocks()
+        runner = api.get_runner(config, StubImageRunner)
+        with locks(runner):
+            with pytest.raises(api.Locked):
+                api.setup(config, runner_class=StubImageRunner, lock=locks)
+
+    def test_container_locks_are_released(self, config):
+        locks = api.ContainerLocks(block=True)
+        runner = api.get_runner(config, StubImageRunner)
+        waiting = threading.Event()
+
+        def wait_for_lock():
+            waiting.set()
+            with locks(runner):
+                pass
+
+        with locks(runner):
+            waiter = threading.Thread(target=wait_for_lock)
+            waiter.start()
+            assert waiting.wait(5)
+        waiter.join(5)
+        assert not waiter.is_alive()
+        assert locks._locks == {}
+
+    def test_file_lock(self, config, tmpdir):
+        lock = api.file_lock(str(tmpdir / 'proc.yaml'))
+        runner = api.get_runner(config, StubImageRunner)
+        with lock(runner):
+            with pytest.raises(api.Locked):
+                with lock(runner):
+                    pass
+
+    def test_uptest_without_uptests(self, config):
+        api.setup(config, runner_class=StubImageRunner)
+        result = api.uptest(config, runner_class=StubImageRunner)
+        assert result.value == []
+
+    @patch('vr.runners.base.which', Mock(return_value=['/usr/bin/lxc-start']))
+    @patch('vr.runners.base.get_lxc_version',
+           Mock(return_value=parse_version('1.0.8')))
+    def test_run_spawns(self, config):
+        with patch('vr.runners.base.subprocess.Popen') as popen:
+            result = api.run(config, runner_class=StubImageRunner)
+        assert result.value is popen.return_value
+        args, kwargs = popen.call_args
+        assert args[0][0] == 'lxc-start'
+        assert kwargs['env'] == {}
+
+
+@patch('vr.runners.image.get_lxc_version',
+       Mock(return_value=parse_version('1.0.8')))
+class TestPrefetch(object):
+
+    def test_prefetch(self, config, artifact_server, tmpdir):
+        image_url = 'http://example.com/os.tar.gz'
+        build_url = 'http://example.com/build.tar.gz'
+        image_tgz = make_tarball('etc/os-release', b'NAME=test')
+        artifact_server.tarballs[image_url] = image_tgz
+        artifact_server.tarballs[build_url] = make_tarball('Procfile', b'')
+        manifest = tmpdir / 'manifest.yaml'
+        manifest.write(
+            '- build_url: %s\n'
+            '- image_url: %s\n'
+            '  image_name: prefetched\n'
+            '  image_md5: %s\n'
+            % (build_url, image_url, hashlib.md5(image_tgz).hexdigest()))
+
+        result = api.prefetch([str(manifest)], rate=1 << 20)
+
+        assert result.command == 'prefetch'
+        assert 'Downloading %s' % image_url in result.output
+        assert os.path.isfile(
+            os.path.join(base.BUILDS_ROOT, 'build.tar.gz'))
+        # The image is unpacked where setup will look for it.
+        config['image_name'] = 'prefetched'
+        image_folder = api.get_runner(config).get_image_folder()
+        assert os.path.isfile(
+            os.path.join(image_folder, 'etc', 'os-release'))
+
+        # Setup then finds the build in place and only unpacks it.
+        artifact_server.reset_mock()
+        config['build_url'] = build_url
+        with patch.object(StubImageRunner, 'untar') as untar:
+            api.setup(config, runner_class=StubImageRunner)
+        assert untar.called
+        assert not artifact_server.called
+
+    def test_prefetch_checksum_mismatch(self, artifact_server):
+        url = 'http://example.com/bad-build.tar.gz'
+        artifact_server.tarballs[url] = make_tarball('Procfile', b'')
+        with pytest.raises(ValueError, match='Checksum mismatch'):
+            api.prefetch([{'build_url': url, 'build_md5': 'not-the-md5'}])
+        assert not os.path.exists(
+            os.path.join(base.BUILDS_ROOT, 'bad-build.tar.gz'))
+
+    def test_prefetch_failed_download(self, artifact_server):
+        url = 'http://example.com/broken-build.tar.gz'
+        artifact_server.side_effect = None
+        artifact_server.return_value = Mock(raw=Mock(
+            read=Mock(side_effect=[b'partial', IOError('connection reset')])))
+        with pytest.raises(IOError):
+            api.prefetch([{'build_url': url}])
+        # Neither the build nor a partial temp file is left behind.
+        assert not [
+            name for name in os.listdir(base.BUILDS_ROOT)
+            if 'broken-build' in name
+        ]
+
+    def test_prefetch_keeps_existing_image(self, artifact_server):
+        url = 'http://example.com/raced.tar.gz'
+        artifact_server.tarballs[url] = make_tarball('new', b'')
+        image_dir = os.path.join(image.IMAGES_ROOT, 'raced')
+        contents = os.path.join(image_dir, 'contents')
+
+        # Another setup unpacks the image while this one is unpacking it.
+        def prepare(*args, **kwargs):
+            os.makedirs(os.path.join(contents, 'in-use'))
+            return base.untar(*args, **kwargs)
+
+        with patch('vr.runners.image.untar', prepare):
+            result = api.prefetch([{'image_url': url, 'image_name': 'raced'}])
+        assert os.listdir(contents) == ['in-use']
+        # The staging dir is cleaned up.
+        assert sorted(os.listdir(image_dir)) == ['contents', 'raced.tar.gz']
+        assert any('exists...not overwriting' in m for m in result.output)
+
+    def test_prefetch_needs_image_name(self):
+        with pytest.raises(ValueError, match='needs an image_name'):
+            api.prefetch([{'image_url': 'http://example.com/os.tar.gz'}])
+
+    def test_prefetch_empty_manifest(self, tmpdir):
+        manifest = tmpdir / 'empty.yaml'
+        manifest.write('')
+        assert api.prefetch([str(manifest)]).output == []
+
+    @pytest.mark.parametrize('value', ['0', '-5', '-1M', 'fast'])
+    def test_parse_rate_rejects(self, value):
+        with pytest.raises(base.argparse.ArgumentTypeError):
+            base.parse_rate(value)
+
+    def test_copy_limited(self):
+        data = os.urandom(200 * 1024)
+        dst = io.BytesIO()
+        start = time.time()
+        base.copy_limited(io.BytesIO(data), dst, rate=1 << 20)
+        # 200 KiB at 1 MiB/s takes about 0.2s.
+        assert time.time() - start >= 0.15
+        assert dst.getvalue() == data
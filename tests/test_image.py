@@ -1,4 +1,6 @@
 import os
+import subprocess
+import threading
 from unittest.mock import Mock, patch
 
 from pkg_resources import parse_version
@@ -6,7 +8,7 @@ import pytest
 from vr.common.models import ProcData
 from vr.common.paths import get_container_path
 
-from vr.runners import image
+from vr.runners import base, image
 
 
 @pytest.fixture()
@@ -76,3 +78,160 @@ class TestImageRunner(object):
         assert 'lxc.network.type = none' in proc_lxc
         assert 'lxc.mount.entry = overlay ' in proc_lxc
         assert 'workdir' in proc_lxc
+
+    @patch('vr.runners.image.get_lxc_version')
+    def test_setup_overlaps_image_and_build(self, get_lxc_version_, runner):
+        get_lxc_version_.return_value = parse_version('1.0.8')
+        build_started = threading.Event()
+
+        def ensure_image():
+            # Only finishes if ensure_build gets to run in the meantime.
+            assert build_started.wait(5)
+            runner.log("Image ready")
+
+        def ensure_build():
+            build_started.set()
+            runner.log("Build ready")
+
+        runner.ensure_image = ensure_image
+        runner.ensure_build = ensure_build
+        output = []
+        runner.log = lambda *args: output.append(' '.join(map(str, args)))
+        runner.setup()
+
+        # Output is reported in step order, not completion order.
+        assert output[:4] == [
+            'Setting up ' + runner.container_name,
+            'Image ready',
+            'Making directories',
+            'Build ready',
+        ]
+
+    @patch('vr.runners.image.get_lxc_version')
+    def test_setup_step_error(self, get_lxc_version_, runner):
+        get_lxc_version_.return_value = parse_version('1.0.8')
+        runner.ensure_build = Mock(side_effect=RuntimeError('bad build'))
+        runner.write_proc_sh = Mock()
+        with pytest.raises(RuntimeError, match='bad build'):
+            runner.setup()
+        assert not runner.write_proc_sh.called
+
+    @patch('vr.runners.image.get_lxc_version')
+    def test_setup_step_exit(self, get_lxc_version_, runner):
+        get_lxc_version_.return_value = parse_version('1.0.8')
+        runner.ensure_build = Mock(side_effect=SystemExit('stop'))
+        with pytest.raises(SystemExit, match='stop'):
+            runner.setup()
+
+    @patch('vr.runners.base.which')
+    @patch('vr.runners.base.get_lxc_version')
+    @patch('vr.runners.image.get_lxc_version')
+    def test_setup_precompute_env(
+            self, get_lxc_version_, base_lxc_version_, which_, runner):
+        get_lxc_version_.return_value = parse_version('1.0.8')
+        base_lxc_version_.return_value = parse_version('1.0.8')
+        which_.return_value = ['/usr/bin/lxc-start']
+        runner.config.user = 'nobody'
+        runner.precompute_env = True
+        p = get_container_path(runner.config)
+
+        def dump_env(args, **kwargs):
+            assert args[-1].endswith('exec /proc.sh "dumpenv"')
+            raw_path = os.path.join(p, 'tmp', 'proc.env.raw')
+            with open(raw_path + '.before', 'wb') as f:
+                f.write(b'HOME=/app\0SUDO_UID=99\0')
+            with open(raw_path, 'wb') as f:
+                f.write(b'HOME=/app\0SUDO_UID=99\0GREETING=it\'s $HOME\0')
+            return b'lxc-start: some warning\n'
+
+        output = []
+        runner.log = lambda *args: output.append(' '.join(args))
+        with patch('vr.runners.base.subprocess.check_output', dump_env):
+            runner.setup()
+
+        assert 'Writing proc.env' in output
+        assert 'lxc-start: some warning' in output
+        with open(os.path.join(p, 'proc.env')) as f:
+            assert f.read() == "export GREETING='it'\"'\"'s $HOME'\n"
+        assert not os.listdir(os.path.join(p, 'tmp'))
+
+        # A start that doesn't write the dumps is reported clearly.
+        silent = Mock(return_value=b'')
+        with patch('vr.runners.base.subprocess.check_output', silent):
+            with pytest.raises(RuntimeError, match='exited without writing'):
+                runner.setup()
+
+        # Setting up again without the option discards the stale proc.env.
+        runner.precompute_env = False
+        runner.setup()
+        assert not os.path.exists(os.path.join(p, 'proc.env'))
+
+
+class TestProcSh(object):
+    """
+    Run the rendered proc.sh template with bash, outside of any container.
+    """
+
+    @pytest.fixture()
+    def proc_sh(self, tmpdir):
+        app = tmpdir.mkdir('app')
+        app.mkdir('.profile.d').join('app.sh').write(
+            'export PROFILE_VAR="from profile"\n'
+            'export PATH="$HOME/bin:$PATH"\n'
+            'unset GIT_DIR\n'
+        )
+        tmpdir.join('env.sh').write('export ENV_VAR="from env.sh"\n')
+        context = {
+            'tmp': str(tmpdir),
+            'home': str(app),
+            'settings': str(tmpdir / 'settings.yaml'),
+            'envsh': str(tmpdir / 'env.sh'),
+            'procenv': str(tmpdir / 'proc.env'),
+            'rawenv': str(tmpdir / 'proc.env.raw'),
+            'port': 4321,
+            'cmd': 'env -0',
+        }
+        proc_sh = tmpdir.join('proc.sh')
+        proc_sh.write(base.get_template('proc.sh') % context)
+        return proc_sh
+
+    def start(self, proc_sh, mode, **env):
+        env.setdefault('PATH', '/usr/bin:/bin')
+        out = subprocess.check_output(
+            ['bash', str(proc_sh), mode], env=env)
+        return base.parse_env_dump(out) if out else None
+
+    def test_dumpenv_and_run(self, proc_sh, tmpdir):
+        assert self.start(
+            proc_sh, 'dumpenv', SUDO_COMMAND='/bin/bash -c dumpenv',
+            GIT_DIR='/x') is None
+        with open(str(tmpdir / 'proc.env.raw.before'), 'rb') as f:
+            before = f.read()
+        with open(str(tmpdir / 'proc.env.raw'), 'rb') as f:
+            after = f.read()
+        changes = base.get_env_changes(before, after)
+        assert sorted(changes) == [
+            'ENV_VAR', 'GIT_DIR', 'PATH', 'PROFILE_VAR']
+        assert changes['GIT_DIR'] is None
+        app_bin = str(tmpdir / 'app' / 'bin')
+        assert changes['PATH'] == app_bin + ':/usr/bin:/bin'
+
+        tmpdir.join('proc.env').write(base.format_env_exports(changes))
+        # Make sure the scripts aren't evaluated on a run with proc.env.
+        tmpdir.join('env.sh').write('exit 1\n')
+
+        env = self.start(
+            proc_sh, 'run', SUDO_COMMAND='/bin/bash -c run', GIT_DIR='/x')
+        assert env['SUDO_COMMAND'] == '/bin/bash -c run'
+        assert 'GIT_DIR' not in env
+        assert env['PROFILE_VAR'] == 'from profile'
+        assert env['ENV_VAR'] == 'from env.sh'
+        assert env['PATH'] == changes['PATH']
+        assert env['PORT'] == '4321'
+
+    def test_run_without_proc_env(self, proc_sh):
+        env = self.start(proc_sh, 'run', GIT_DIR='/x')
+        assert 'GIT_DIR' not in env
+        assert env['PROFILE_VAR'] == 'from profile'
+        assert env['ENV_VAR'] == 'from env.sh'
+        assert env['PORT'] == '4321'
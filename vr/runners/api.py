@@ -0,0 +1,232 @@
+"""
+Drive runners from Python, without going through argparse, a proc.yaml file
+or a new interpreter for each operation.
+
+Each function takes the proc config as a ProcData or a plain dict and
+returns a Result:
+
+>>> result = teardown({'app_name': 'app', 'version': '1',
+...                    'config_name': 'prod', 'release_hash': 'abc',
+...                    'proc_name': 'web', 'port': 5000})
+>>> result.command, result.container_name, result.value
+('teardown', 'app-1-prod-abc-web-5000', None)
+>>> result.elapsed >= 0
+True
+"""
+import collections
+import contextlib
+import json
+import subprocess
+import threading
+import time
+
+import six
+from vr.common.models import ProcData
+from vr.common.utils import lock_file
+
+from vr.runners.base import load_artifacts, lower_priority
+from vr.runners.image import ImageRunner
+
+
+# The outcome of a runner command.  'value' is whatever the command produces
+# (the Popen object for a spawned run, the parsed uptest results), 'output' is
+# the list of progress messages the runner logged, and 'elapsed' is the time
+# taken in seconds, including any time spent waiting for the lock.
+Result = collections.namedtuple(
+    'Result', 'command container_name value output elapsed')
+
+
+class Locked(Exception):
+    """
+    Raised when a proc is already locked by another caller.
+    """
+
+
+@contextlib.contextmanager
+def no_lock(runner):
+    """
+    Lock that doesn't lock, for callers that serialize procs themselves.
+    """
+    yield
+
+
+class ContainerLocks(object):
+    """
+    Per-container locks for callers running many procs from one process.
+
+    >>> locks = ContainerLocks()
+    >>> runner = get_runner({'app_name': 'app', 'version': '1',
+    ...                      'config_name': 'prod', 'release_hash': 'abc',
+    ...                      'proc_name': 'web', 'port': 5000})
+    >>> with locks(runner):
+    ...     with locks(runner):
+    ...         pass
+    Traceback (most recent call last):
+    ...
+    vr.runners.api.Locked: app-1-prod-abc-web-5000 is locked by another caller.
+
+    Locks for containers nobody is using aren't kept around.
+
+    >>> locks._locks
+    {}
+    """
+
+    def __init__(self, block=False):
+        self.block = block
+        # Container name -> [lock, number of callers holding or waiting for
+        # it], so entries can be dropped once nobody is using them.
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextlib.contextmanager
+    def __call__(self, runner):
+        name = runner.container_name
+        with self._guard:
+            entry = self._locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            if not entry[0].acquire(self.block):
+                raise Locked("%s is locked by another caller." % name)
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[name]
+
+
+def file_lock(path, block=False):
+    """
+    Return a lock that flocks the file at path, as the command line runner
+    does with the proc.yaml, so API callers and vrun can share procs safely.
+    """
+    @contextlib.contextmanager
+    def lock(runner):
+        with open(path, 'a') as f:
+            try:
+                lock_file(f, block)
+            except SystemExit:
+                # lock_file exits when the file is already locked.
+                raise Locked("%s is locked by another process." % path)
+            yield
+    return lock
+
+
+container_locks = ContainerLocks()
+
+
+def get_runner(config, runner_class=ImageRunner):
+    """
+    Return a runner_class instance for config, which may be a ProcData or a
+    dict as would be loaded from a proc.yaml.
+    """
+    if not isinstance(config, ProcData):
+        config = ProcData(config)
+    return runner_class(config)
+
+
+def capture_log(runner):
+    """
+    Make runner log to a list instead of printing, and return the list.
+    """
+    output = []
+    runner.log = lambda *args: output.append(' '.join(map(str, args)))
+    return output
+
+
+def call(command, runner, lock=container_locks, **kwargs):
+    """
+    Run the named runner method under lock, collecting the runner's progress
+    messages, and return a Result.  Extra keyword arguments are passed to
+    the method.
+    """
+    start = time.time()
+    output = capture_log(runner)
+    with lock(runner):
+        value = getattr(runner, command)(**kwargs)
+    return Result(
+        command, runner.container_name, value, output, time.time() - start)
+
+
+def setup(config, runner_class=ImageRunner, lock=container_locks,
+          precompute_env=None):
+    """
+    Set up the proc described by config.  If precompute_env is given, it
+    overrides the runner class's precompute_env setting.
+    """
+    runner = get_runner(config, runner_class)
+    if precompute_env is not None:
+        runner.precompute_env = precompute_env
+    return call('setup', runner, lock)
+
+
+def teardown(config, runner_class=ImageRunner, lock=container_locks):
+    """
+    Remove everything setup put in place for the proc described by config.
+    """
+    return call('teardown', get_runner(config, runner_class), lock)
+
+
+def run(config, runner_class=ImageRunner, lock=container_locks):
+    """
+    Start the proc described by config as a child process, rather than
+    replacing the current one.  The Result's value is the subprocess.Popen
+    for lxc-start.
+    """
+    return call('run', get_runner(config, runner_class), lock, spawn=True)
+
+
+def uptest(config, runner_class=ImageRunner, lock=no_lock):
+    """
+    Run the uptests for the proc described by config and wait for them.  The
+    Result's value is the list of uptest results reported by the uptester.
+
+    Uptests don't modify the proc, so they don't take a lock by default.
+    """
+    start = time.time()
+    result = call(
+        'uptest', get_runner(config, runner_class), lock, spawn=True)
+    proc = result.value
+    results = []
+    if proc is not None:
+        out, _ = proc.communicate()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, 'uptester')
+        results = json.loads(out.decode('utf-8'))
+    return result._replace(value=results, elapsed=time.time() - start)
+
+
+def prefetch(artifacts, runner_class=ImageRunner, extract=True, rate=None,
+             low_priority=False):
+    """
+    Download, verify and (unless extract is False) unpack the builds and OS
+    images that setup will need, ahead of time.  Each item in artifacts may be
+    a ProcData, a dict with proc.yaml keys, or the path to a proc.yaml or
+    manifest file.  If rate is given, downloads are limited to that many bytes
+    per second.
+
+    If low_priority is True, the whole calling process is given the lowest CPU
+    and I/O priority, which can't be undone, so only use it in a process
+    dedicated to prefetching.
+
+    Prefetching doesn't touch any proc, so it takes no lock, and the Result's
+    container_name is None.
+    """
+    start = time.time()
+    if low_priority:
+        lower_priority()
+    entries = []
+    for item in artifacts:
+        if isinstance(item, six.string_types):
+            entries.extend(load_artifacts(item))
+        elif isinstance(item, ProcData):
+            entries.append(item.as_dict())
+        else:
+            entries.append(item)
+    runner = runner_class()
+    output = capture_log(runner)
+    runner.prefetch(entries, extract=extract, rate=rate)
+    return Result('prefetch', None, None, output, time.time() - start)
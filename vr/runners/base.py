@@ -2,11 +2,20 @@
 from __future__ import print_function
 
 import argparse
+import collections
+import contextlib
 import hashlib
+import io
 import os
+import re
 import shutil
 import stat
+import subprocess
+import sys
 import tarfile
+import tempfile
+import threading
+import time
 
 import pkg_resources
 import requests
@@ -19,7 +28,7 @@ from vr.common.paths import (
     get_container_path, get_proc_path, get_lxc_work_path)
 from vr.common.models import ProcData
 from vr.common.utils import (
-    tmpdir, mkdir, lock_file, which, file_md5,
+    mkdir, lock_file, which, file_md5,
     get_lxc_version, get_lxc_network_config)
 
 
@@ -36,6 +45,24 @@ class BaseRunner(object):
     True
     """
 
+    # When True, setup evaluates the .profile.d scripts and env.sh once
+    # inside the container and writes the result to proc.env, which proc.sh
+    # then loads instead of re-evaluating those scripts on every start.
+    # Only exported variables survive this; umask, ulimit, set -o, shell
+    # functions and unexported variables set by the scripts are lost.
+    precompute_env = False
+
+    def __init__(self, config=None):
+        if config is not None:
+            self.config = config
+
+    def log(self, *args):
+        """
+        Report progress.  Callers driving the runner from Python (see
+        vr.runners.api) may replace this to collect the messages instead.
+        """
+        print(*args)
+
     def main(self):
         self.commands = {
             'setup': self.setup,
@@ -43,6 +70,7 @@ class BaseRunner(object):
             'shell': self.shell,
             'uptest': self.uptest,
             'teardown': self.teardown,
+            'prefetch': self.prefetch,
         }
 
         # pylint: disable=unused-variable
@@ -50,11 +78,31 @@ class BaseRunner(object):
         parser = argparse.ArgumentParser()
         cmd_help = 'One of: {cmd_list}'.format(**locals())
         parser.add_argument('command', help=cmd_help)
-        parser.add_argument('file', help="Path to proc.yaml file.")
+        parser.add_argument(
+            'file', nargs='+',
+            help="Path to proc.yaml file.  prefetch accepts several, as well "
+            "as manifests listing build_url/build_md5 and "
+            "image_url/image_name/image_md5 entries.")
+        parser.add_argument(
+            '--precompute-env', action='store_true',
+            default=self.precompute_env,
+            help="On setup, flatten the environment built by .profile.d and "
+            "env.sh into proc.env, which later starts load instead.  Only "
+            "exported variables are kept, as they were at setup time; umask, "
+            "ulimit, set -o, shell functions and unexported variables set by "
+            "those scripts are lost.")
+        parser.add_argument(
+            '--rate', type=parse_rate,
+            help="On prefetch, cap download bandwidth (bytes per second, "
+            "with an optional K, M or G suffix).")
+        parser.add_argument(
+            '--no-extract', dest='extract', action='store_false',
+            help="On prefetch, download images without unpacking them.")
         parser.add_argument(
             '--version', action='version', version=get_version())
 
         args = parser.parse_args()
+        self.precompute_env = args.precompute_env
 
         try:
             cmd = self.commands[args.command]
@@ -62,7 +110,19 @@ class BaseRunner(object):
             msg = 'Command must be one of: {cmd_list}'.format(**locals())
             raise SystemExit(msg)
 
-        with open(args.file, 'r+b') as fid:
+        if args.command == 'prefetch':
+            # Prefetch doesn't touch any proc, so there's nothing to lock.
+            lower_priority()
+            artifacts = []
+            for filename in args.file:
+                artifacts.extend(load_artifacts(filename))
+            cmd(artifacts, extract=args.extract, rate=args.rate)
+            return
+
+        if len(args.file) > 1:
+            parser.error('%s takes a single proc.yaml file' % args.command)
+
+        with open(args.file[0], 'r+b') as fid:
             self.config = ProcData(yaml.safe_load(fid))
 
             # Lock the file for exclusive access. Some commands (such as shell
@@ -80,26 +140,33 @@ class BaseRunner(object):
         fid.close()
 
     def setup(self):
-        print("Setting up", self.container_name)
+        self.log("Setting up", self.container_name)
         self.make_proc_dirs()
         self.ensure_build()
         self.write_proc_lxc()
         self.write_settings_yaml()
         self.write_proc_sh()
         self.write_env_sh()
+        self.ensure_proc_env()
 
-    def run(self):
-        print("Running", self.container_name)
+    def run(self, spawn=False):
+        """
+        Start the proc's container, replacing the current process.  If spawn
+        is True, start it as a child instead and return the Popen object.
+        """
+        self.log("Running", self.container_name)
+        if spawn:
+            return self._lxc_spawn()
         self._lxc_start()
 
     def shell(self):
-        print("Running shell for", self.container_name)
+        self.log("Running shell for", self.container_name)
         self._lxc_start(special_cmd='/bin/bash')
     shell.lock = __close_file
 
     def untar(self):
         tarpath = get_buildfile_path(self.config)
-        print("Untarring", tarpath)
+        self.log("Untarring", tarpath)
         outfolder = get_app_path(self.config)
         owners = (self.config.user, self.config.group)
         untar(tarpath, outfolder, owners)
@@ -109,12 +176,14 @@ class BaseRunner(object):
         Write the script that is the first thing called inside the
         container.  It sets env vars and then calls the real program.
         """
-        print("Writing proc.sh")
+        self.log("Writing proc.sh")
         context = {
             'tmp': '/tmp',
             'home': '/app',
             'settings': '/settings.yaml',
             'envsh': '/env.sh',
+            'procenv': '/proc.env',
+            'rawenv': '/tmp/proc.env.raw',
             'port': self.config.port,
             'cmd': self.get_cmd(),
         }
@@ -127,7 +196,7 @@ class BaseRunner(object):
             sh_path, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
     def write_env_sh(self):
-        print("Writing env.sh")
+        self.log("Writing env.sh")
         envsh_path = os.path.join(get_container_path(self.config), 'env.sh')
 
         with open(envsh_path, 'w') as f:
@@ -144,6 +213,75 @@ class BaseRunner(object):
             env_str = '\n'.join(format_var(k, e[k]) for k in e) + '\n'
             f.write(env_str)
 
+    def ensure_proc_env(self):
+        """
+        If self.precompute_env is set, write proc.env.  Otherwise remove any
+        proc.env left over from an earlier setup, so proc.sh falls back to
+        evaluating .profile.d and env.sh itself.
+        """
+        if self.precompute_env:
+            self.write_proc_env()
+            return
+
+        procenv_path = os.path.join(
+            get_container_path(self.config), 'proc.env')
+        if os.path.isfile(procenv_path):
+            os.remove(procenv_path)
+
+    def write_proc_env(self):
+        """
+        Start the container once with proc.sh in 'dumpenv' mode, so the
+        .profile.d scripts and env.sh are evaluated exactly as they would be
+        for the real proc, capturing the environment before and after they
+        run.  Write the variables they set, changed or unset to proc.env as a
+        flat list of exports and unsets.
+        """
+        self.log("Writing proc.env")
+        container_path = get_container_path(self.config)
+        tmp_path = os.path.join(container_path, 'tmp')
+        mkdir(tmp_path)
+        os.chmod(tmp_path, 0o1777)
+        raw_path = os.path.join(tmp_path, 'proc.env.raw')
+        raw_paths = raw_path + '.before', raw_path
+        for path_ in raw_paths:
+            if os.path.exists(path_):
+                os.remove(path_)
+
+        args = self.get_lxc_args(special_cmd='dumpenv')
+        output = b''
+        try:
+            output = subprocess.check_output(
+                args, executable=which('lxc-start')[0], env={},
+                stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            output = e.output or b''
+            raise
+        finally:
+            # Pass on whatever the container printed, such as errors from
+            # the .profile.d scripts.
+            for line in output.decode('utf-8', 'replace').splitlines():
+                self.log(line)
+
+        try:
+            dumps = []
+            for path_ in raw_paths:
+                if not os.path.isfile(path_):
+                    raise RuntimeError(
+                        'Capturing the environment for proc.env failed: '
+                        'the container exited without writing %s' % path_)
+                with open(path_, 'rb') as f:
+                    dumps.append(f.read())
+        finally:
+            for path_ in raw_paths:
+                if os.path.exists(path_):
+                    os.remove(path_)
+        env = get_env_changes(*dumps, log=self.log)
+
+        procenv_path = os.path.join(container_path, 'proc.env')
+        with io.open(procenv_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(format_env_exports(env))
+        os.rename(procenv_path + '.tmp', procenv_path)
+
     def get_cmd(self):
         """
         If self.config.cmd is not None, return that.
@@ -188,13 +326,35 @@ class BaseRunner(object):
             # Ensure that builds_root has been created.
             mkdir(BUILDS_ROOT)
             build_md5 = getattr(self.config, 'build_md5', None)
-            ensure_file(self.config.build_url, path, build_md5)
+            ensure_file(self.config.build_url, path, build_md5, self.log)
 
             # Now untar.
             self.untar()
 
+    def prefetch(self, artifacts, extract=True, rate=None):
+        """
+        Download the builds named in artifacts, a list of dicts with the
+        build_url and (optionally) build_md5 keys of a proc.yaml, into
+        BUILDS_ROOT and verify them, so that a later setup finds them in
+        place.  Builds are unpacked separately for each proc at setup, so
+        extract only applies to runners that also fetch images.
+
+        If rate is given, downloads are limited to that many bytes per
+        second.
+        """
+        urls = set()
+        for artifact in artifacts:
+            url = artifact.get('build_url')
+            if not url or url in urls:
+                continue
+            urls.add(url)
+            mkdir(BUILDS_ROOT)
+            fetch_file(
+                url, os.path.join(BUILDS_ROOT, os.path.basename(url)),
+                artifact.get('build_md5'), self.log, rate)
+
     def write_settings_yaml(self):
-        print("Writing settings.yaml")
+        self.log("Writing settings.yaml")
         path = os.path.join(get_container_path(self.config), 'settings.yaml')
         with open(path, 'w') as f:
             f.write(
@@ -204,6 +364,15 @@ class BaseRunner(object):
         args = self.get_lxc_args(special_cmd=special_cmd)
         os.execve(which('lxc-start')[0], args, {})
 
+    def _lxc_spawn(self, special_cmd=None, **kwargs):
+        """
+        Like _lxc_start, but run lxc-start as a child process.  Extra
+        keyword arguments are passed to subprocess.Popen.
+        """
+        args = self.get_lxc_args(special_cmd=special_cmd)
+        return subprocess.Popen(
+            args, executable=which('lxc-start')[0], env={}, **kwargs)
+
     def get_lxc_args(self, special_cmd=None):
 
         name = self.container_name
@@ -276,7 +445,12 @@ class BaseRunner(object):
                 outside, get_container_path(self.config), inside)
         return content
 
-    def uptest(self):
+    def uptest(self, spawn=False):
+        """
+        Run the proc's uptests, replacing the current process.  If spawn is
+        True, run them as a child instead and return the Popen object (with
+        stdout piped), or None if the proc has no uptests.
+        """
         # copy the uptester into the container. ensure it's executable.
         src = pkg_resources.resource_filename(
             'vr.runners', 'uptester/uptester')
@@ -287,19 +461,25 @@ class BaseRunner(object):
         os.chmod(dest, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
         proc_name = getattr(self.config, 'proc_name', None)
-        if proc_name:
-            app_path = get_app_path(self.config)
-            uptests_path = os.path.join(app_path, 'uptests', proc_name)
-            if os.path.isdir(uptests_path):
-                # run an LXC container for the uptests.
-                inside_path = os.path.join('/app/uptests', proc_name)
-                cmd = '/uptester %s %s %s ' % (inside_path, self.config.host,
-                                               self.config.port)
-                self._lxc_start(special_cmd=cmd)
-            else:
+        if not proc_name:
+            return None
+
+        app_path = get_app_path(self.config)
+        uptests_path = os.path.join(app_path, 'uptests', proc_name)
+        if not os.path.isdir(uptests_path):
+            if not spawn:
                 # There are no uptests for this proc.  Output an empty
                 # JSON list.
                 print("[]")
+            return None
+
+        # run an LXC container for the uptests.
+        inside_path = os.path.join('/app/uptests', proc_name)
+        cmd = '/uptester %s %s %s ' % (inside_path, self.config.host,
+                                       self.config.port)
+        if spawn:
+            return self._lxc_spawn(special_cmd=cmd, stdout=subprocess.PIPE)
+        self._lxc_start(special_cmd=cmd)
     uptest.lock = __close_file
 
     def teardown(self):
@@ -312,7 +492,7 @@ class BaseRunner(object):
             shutil.rmtree(proc_path)
 
     def make_proc_dirs(self):
-        print("Making directories")
+        self.log("Making directories")
 
         proc_path = get_proc_path(self.config)
         mkdir(proc_path)
@@ -351,7 +531,7 @@ class BaseRunner(object):
         }
 
     def write_proc_lxc(self):
-        print("Writing proc.lxc")
+        self.log("Writing proc.lxc")
         proc_path = get_proc_path(self.config)
         tmpl = get_template(self.lxc_template_name)
         content = tmpl % self.get_proc_lxc_tmpl_ctx()
@@ -387,7 +567,8 @@ def untar(tarpath, outfolder, owners=None, overwrite=True, fixperms=True):
     _ignored = fixperms  # noqa
 
     # make a folder to untar to
-    with tmpdir():
+    with tmpdir() as tmp:
+        contents_path = os.path.join(tmp, 'contents')
         _, _, ext = tarpath.rpartition('.')
 
         if ext not in ('gz', 'bz2', 'xz'):
@@ -395,13 +576,13 @@ def untar(tarpath, outfolder, owners=None, overwrite=True, fixperms=True):
 
         tf = tarfile.open(tarpath, 'r:' + ext)
         try:
-            os.mkdir('contents')
-            tf.extractall('contents')
+            os.mkdir(contents_path)
+            tf.extractall(contents_path)
         finally:
             tf.close()
 
         if owners is not None:
-            contents = path.Path('contents')
+            contents = path.Path(contents_path)
             for item in contents.walk():
                 if item.isdir():
                     # chown user:group
@@ -421,10 +602,10 @@ def untar(tarpath, outfolder, owners=None, overwrite=True, fixperms=True):
                 raise IOError(
                     ('Cannot untar %s because %s already exists and '
                      'overwrite=False') % (tarfile, outfolder))
-        shutil.move('contents', outfolder)
+        shutil.move(contents_path, outfolder)
 
 
-def ensure_file(url, path, md5sum=None):
+def ensure_file(url, path, md5sum=None, log=print, rate=None):
     """
     If file is not already at 'path', then download from 'url' and put it
     there.
@@ -434,18 +615,312 @@ def ensure_file(url, path, md5sum=None):
     """
 
     if not os.path.isfile(path) or (md5sum and md5sum != file_md5(path)):
-        download_file(url, path)
+        download_file(url, path, log, rate)
+
+
+def fetch_file(url, path, md5sum=None, log=print, rate=None):
+    """
+    Like ensure_file, but also check the file against md5sum after
+    downloading it.  If it doesn't match, remove it and raise ValueError.
+    """
+    ensure_file(url, path, md5sum, log, rate)
+    if md5sum and md5sum != file_md5(path):
+        os.remove(path)
+        raise ValueError('Checksum mismatch for %s' % url)
+
 
+def download_file(url, path, log=print, rate=None):
+    """
+    Download url to path.  If rate is given, limit the download to that many
+    bytes per second.
 
-def download_file(url, path):
-    with tmpdir():
-        print("Downloading %s" % url)
-        base = os.path.basename(path)
-        with open(base, 'wb') as f:
+    The download goes to a temp file next to path, which is renamed into
+    place when complete, so other processes never see a partial file.
+    """
+    log("Downloading %s" % url)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix='.%s.' % os.path.basename(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
             resp = requests.get(url, stream=True)
             resp.raise_for_status()
-            shutil.copyfileobj(resp.raw, f)
-        shutil.move(base, path)
+            if rate:
+                copy_limited(resp.raw, f, rate)
+            else:
+                shutil.copyfileobj(resp.raw, f)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def copy_limited(src, dst, rate, chunk_size=64 * 1024):
+    """
+    Copy file-like object src to dst, sleeping as needed to stay under rate
+    bytes per second.
+    """
+    start = time.time()
+    copied = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+        delay = copied / float(rate) - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_rate(value):
+    """
+    Parse a bandwidth given as bytes per second, with an optional K, M or G
+    suffix.
+
+    >>> parse_rate('512'), parse_rate('10k'), parse_rate('2M')
+    (512, 10240, 2097152)
+    >>> parse_rate('0')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: invalid rate: '0'
+    """
+    multipliers = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    number = value.strip().upper()
+    multiplier = multipliers.get(number[-1:], 1)
+    if multiplier > 1:
+        number = number[:-1]
+    try:
+        rate = int(number) * multiplier
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        raise argparse.ArgumentTypeError('invalid rate: %r' % value)
+    return rate
+
+
+def load_artifacts(filename):
+    """
+    Load the artifacts to prefetch from filename, which may be a proc.yaml
+    or a manifest holding a list of dicts with the same artifact keys.  An
+    empty file holds no artifacts.
+    """
+    with open(filename) as f:
+        doc = yaml.safe_load(f)
+    if doc is None:
+        return []
+    artifacts = doc if isinstance(doc, list) else [doc]
+    for artifact in artifacts:
+        if not isinstance(artifact, dict):
+            raise ValueError(
+                'Invalid entry in %s: %r' % (filename, artifact))
+    return artifacts
+
+
+def lower_priority():
+    """
+    Give this process the lowest CPU and (where ionice is available) idle
+    I/O priority, so background work doesn't slow down running procs.
+    """
+    os.nice(19)
+    ionice = which('ionice')
+    if ionice:
+        subprocess.call([ionice[0], '-c', '3', '-p', str(os.getpid())])
+
+
+@contextlib.contextmanager
+def tmpdir():
+    """
+    Create a temp dir and remove it after.  Unlike vr.common.utils.tmpdir,
+    this doesn't change the working directory, which is shared by all the
+    threads running setup steps.
+    """
+    target = tempfile.mkdtemp()
+    try:
+        yield target
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+def run_steps(runner, steps):
+    """
+    Run the named runner methods in steps, a sequence of
+    (name, dependencies) pairs, each in its own thread as soon as the steps
+    it depends on have finished.
+
+    Messages the steps send to runner.log are held back and passed on in the
+    order the steps are listed, so the output reads as if they had run one
+    after another.  If a step fails, no further steps are started, and the
+    first error is re-raised once the running steps have finished.
+    """
+    log = runner.log
+    local = threading.local()
+
+    def buffered_log(*args):
+        buffer = getattr(local, 'buffer', None)
+        if buffer is None:
+            log(*args)
+        else:
+            buffer.append(args)
+
+    def run_step(name):
+        local.buffer = buffers[name]
+        error = None
+        try:
+            getattr(runner, name)()
+        except BaseException:
+            # Report anything, including SystemExit, so the main thread
+            # isn't left waiting for this step and can re-raise it.
+            error = sys.exc_info()
+        finally:
+            finished.put((name, error))
+
+    names = [name for name, _ in steps]
+    buffers = dict((name, []) for name in names)
+    finished = six.moves.queue.Queue()
+    pending = collections.OrderedDict(steps)
+    running = set()
+    done = set()
+    errors = []
+
+    def flush(final=False):
+        # Pass on the output of the leading steps that have finished.  At
+        # the end, also that of steps after any that were never started.
+        while names and (final or (
+                names[0] not in pending and names[0] not in running)):
+            for args in buffers.pop(names.pop(0)):
+                log(*args)
+
+    had_log = 'log' in vars(runner)
+    runner.log = buffered_log
+    try:
+        while pending or running:
+            ready = [
+                name for name, deps in pending.items()
+                if done.issuperset(deps) and not errors
+            ]
+            for name in ready:
+                del pending[name]
+                running.add(name)
+                thread = threading.Thread(target=run_step, args=(name,))
+                thread.daemon = True
+                thread.start()
+            if not running:
+                break
+
+            name, error = finished.get()
+            running.remove(name)
+            if error:
+                errors.append(error)
+            else:
+                done.add(name)
+            flush()
+        flush(final=True)
+    finally:
+        if had_log:
+            runner.log = log
+        else:
+            del runner.log
+
+    if pending and not errors:
+        raise ValueError(
+            'Unsatisfiable step dependencies: %s' % ', '.join(pending))
+    if errors:
+        six.reraise(*errors[0])
+
+
+# Variables that describe the capturing shell rather than the app's
+# environment, and so shouldn't be carried over into proc.env.
+_SHELL_ENV_VARS = frozenset(['_', 'PWD', 'OLDPWD', 'SHLVL'])
+
+_ENV_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def parse_env_dump(data, log=print):
+    """
+    Parse the NUL-separated output of ``env -0`` into a dict, leaving out
+    shell bookkeeping variables, names that can't be exported from a shell
+    script (such as exported bash functions) and entries that aren't UTF-8.
+
+    >>> env = parse_env_dump(
+    ...     b'A=1\\0B=x=y\\0SHLVL=2\\0BASH_FUNC_f%%=() {}\\0C=\\xff\\0')
+    Not saving BASH_FUNC_f%% to proc.env
+    Not saving undecodable entry b'C=\\xff' to proc.env
+    >>> sorted(env.items())
+    [('A', '1'), ('B', 'x=y')]
+
+    Raise ValueError if the dump is empty or malformed.
+
+    >>> parse_env_dump(b'')
+    Traceback (most recent call last):
+    ...
+    ValueError: Empty environment dump
+    """
+    entries = [item for item in data.split(b'\0') if item]
+    if not entries:
+        raise ValueError('Empty environment dump')
+
+    env = {}
+    for entry in entries:
+        try:
+            key, sep, val = entry.decode('utf-8').partition('=')
+        except UnicodeDecodeError:
+            log("Not saving undecodable entry %r to proc.env" % entry)
+            continue
+        if not sep:
+            raise ValueError('Malformed environment entry: %r' % entry)
+        if key in _SHELL_ENV_VARS:
+            continue
+        if not _ENV_NAME_RE.match(key):
+            log("Not saving %s to proc.env" % key)
+            continue
+        env[key] = val
+    return env
+
+
+def get_env_changes(before, after, log=print):
+    """
+    Given ``env -0`` dumps taken before and after the .profile.d scripts and
+    env.sh ran, return the variables that they set or changed, and map those
+    they unset to None.  The rest (sudo's and LXC's variables, TERM and so
+    on) belong to the particular start that was captured, so are left for
+    each start to set itself.
+
+    >>> changes = get_env_changes(
+    ...     b'A=1\\0B=2\\0D=5\\0SUDO_COMMAND=dumpenv\\0',
+    ...     b'A=1\\0B=3\\0C=4\\0SUDO_COMMAND=dumpenv\\0')
+    >>> sorted(changes.items())
+    [('B', '3'), ('C', '4'), ('D', None)]
+    """
+    before = parse_env_dump(before, log=lambda *args: None)
+    after = parse_env_dump(after, log)
+    changes = dict(
+        (key, val) for key, val in after.items()
+        if before.get(key) != val
+    )
+    changes.update((key, None) for key in before if key not in after)
+    return changes
+
+
+def format_env_exports(env):
+    """
+    Render a dict of environment variables as a shell script that exports
+    them, quoted so that sourcing it doesn't expand anything.  Variables
+    mapped to None are unset.
+
+    >>> env = {'B': "it's", 'A': '$HOME', 'C': None}
+    >>> print(format_env_exports(env), end='')
+    export A='$HOME'
+    export B='it'"'"'s'
+    unset C
+    """
+    def format_var(key):
+        if env[key] is None:
+            return 'unset %s\n' % key
+        return 'export %s=%s\n' % (key, six.moves.shlex_quote(env[key]))
+
+    return ''.join(format_var(key) for key in sorted(env))
 
 
 def get_template(name):
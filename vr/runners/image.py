@@ -1,7 +1,10 @@
 from __future__ import print_function, unicode_literals
 
+import errno
 import os
+import shutil
 import stat
+import tempfile
 
 import path
 
@@ -10,37 +13,66 @@ from vr.common.paths import (
 from vr.common.utils import (
     get_lxc_version, get_lxc_overlayfs_config_fmt,
     get_lxc_network_config)
-from vr.runners.base import BaseRunner, mkdir, ensure_file, untar
+from vr.runners.base import (
+    BaseRunner, mkdir, ensure_file, fetch_file, untar, run_steps)
 
 
 IMAGES_ROOT = VR_ROOT + '/images'
 
 
-def ensure_image(name, url, images_root, md5, untar_to=None):
-    """Ensure OS image at url has been downloaded and (optionally) unpacked."""
+def ensure_image(name, url, images_root, md5, untar_to=None, log=print,
+                 rate=None, verify=False):
+    """Ensure OS image at url has been downloaded and (optionally) unpacked.
+
+    If rate is given, limit the download to that many bytes per second.  If
+    verify is True, also check a fresh download against md5 (see
+    vr.runners.base.fetch_file).
+
+    """
     image_dir_path = os.path.join(images_root, name)
     mkdir(image_dir_path)
     image_file_path = os.path.join(image_dir_path, os.path.basename(url))
-    ensure_file(url, image_file_path, md5)
+    get_file = fetch_file if verify else ensure_file
+    get_file(url, image_file_path, md5, log, rate)
     if untar_to:
-        prepare_image(image_file_path, untar_to)
+        log("Untarring", image_file_path)
+        prepare_image(image_file_path, untar_to, log)
 
 
-def prepare_image(tarpath, outfolder, **kwargs):
+def prepare_image(tarpath, outfolder, log=print, **kwargs):
     """Unpack the OS image stored at tarpath to outfolder.
 
     Prepare the unpacked image for use as a VR base image.
 
-    """
-    outfolder = path.Path(outfolder)
-    untar(tarpath, outfolder, **kwargs)
+    The image is unpacked next to outfolder and renamed into place when
+    ready, as containers may already be using an outfolder unpacked by a
+    concurrent setup or prefetch.  If outfolder exists by then, it's left
+    alone.
 
-    # Some OSes have started making /etc/resolv.conf into a symlink to
-    # /run/resolv.conf.  That prevents us from bind-mounting to that
-    # location.  So delete that symlink, if it exists.
-    resolv_path = outfolder / 'etc' / 'resolv.conf'
-    if resolv_path.islink():
-        resolv_path.remove().write_text('', encoding='ascii')
+    """
+    staging = tempfile.mkdtemp(
+        dir=os.path.dirname(outfolder),
+        prefix='.%s.' % os.path.basename(outfolder))
+    try:
+        staged = path.Path(staging) / 'contents'
+        untar(tarpath, staged, **kwargs)
+
+        # Some OSes have started making /etc/resolv.conf into a symlink to
+        # /run/resolv.conf.  That prevents us from bind-mounting to that
+        # location.  So delete that symlink, if it exists.
+        resolv_path = staged / 'etc' / 'resolv.conf'
+        if resolv_path.islink():
+            resolv_path.remove().write_text('', encoding='ascii')
+
+        try:
+            os.rename(staged, outfolder)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            log('OS image directory {} exists...not overwriting'.format(
+                outfolder))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
 
 
 class ImageRunner(BaseRunner):
@@ -63,18 +95,28 @@ class ImageRunner(BaseRunner):
         ('/dev/urandom', (1, 9), 0o444),
     )
 
+    # The steps of setup, with the steps each depends on.  Fetching and
+    # unpacking the OS image and the build are independent of each other, so
+    # setup runs them (and anything else that's ready) concurrently.
+    setup_steps = (
+        ('ensure_image', ()),
+        ('make_proc_dirs', ()),
+        ('ensure_build', ('make_proc_dirs',)),
+        ('ensure_char_devices', ('make_proc_dirs',)),
+        ('write_proc_lxc', ('ensure_image', 'make_proc_dirs')),
+        ('write_settings_yaml', ('make_proc_dirs',)),
+        ('write_proc_sh', ('ensure_build',)),
+        ('write_env_sh', ('make_proc_dirs',)),
+        ('ensure_container', ('write_proc_lxc',)),
+        ('ensure_proc_env', (
+            'ensure_char_devices', 'write_settings_yaml', 'write_proc_sh',
+            'write_env_sh', 'ensure_container')),
+    )
+
     def setup(self):
-        print("Setting up", self.container_name)
+        self.log("Setting up", self.container_name)
         mkdir(IMAGES_ROOT)
-        self.ensure_image()
-        self.make_proc_dirs()
-        self.ensure_build()
-        self.ensure_char_devices()
-        self.write_proc_lxc()
-        self.write_settings_yaml()
-        self.write_proc_sh()
-        self.write_env_sh()
-        self.ensure_container()
+        run_steps(self, self.setup_steps)
 
     def ensure_image(self):
         """
@@ -82,7 +124,7 @@ class ImageRunner(BaseRunner):
         """
         image_folder = self.get_image_folder()
         if os.path.exists(image_folder):
-            print(
+            self.log(
                 'OS image directory {} exists...not overwriting' .format(
                     image_folder))
             return
@@ -92,11 +134,52 @@ class ImageRunner(BaseRunner):
             self.config.image_url,
             IMAGES_ROOT,
             getattr(self.config, 'image_md5', None),
-            self.get_image_folder()
+            self.get_image_folder(),
+            self.log,
         )
 
-    def get_image_folder(self):
-        return os.path.join(IMAGES_ROOT, self.config.image_name, 'contents')
+    def get_image_folder(self, image_name=None):
+        """
+        Return the folder the image named image_name (by default, the proc's
+        config.image_name) is unpacked to.
+        """
+        image_name = image_name or self.config.image_name
+        return os.path.join(IMAGES_ROOT, image_name, 'contents')
+
+    def prefetch(self, artifacts, extract=True, rate=None):
+        """
+        Download and verify the builds and OS images named in artifacts (see
+        BaseRunner.prefetch), and unless extract is False, unpack the images
+        where setup expects them.  Images that are already unpacked are
+        skipped.
+        """
+        super(ImageRunner, self).prefetch(artifacts, extract, rate)
+        urls = set()
+        for artifact in artifacts:
+            url = artifact.get('image_url')
+            if not url or url in urls:
+                continue
+            urls.add(url)
+            if not artifact.get('image_name'):
+                raise ValueError(
+                    'Artifact with image_url needs an image_name: %r' %
+                    artifact)
+            image_folder = self.get_image_folder(artifact['image_name'])
+            if os.path.exists(image_folder):
+                self.log(
+                    'OS image directory {} exists...skipping'.format(
+                        image_folder))
+                continue
+            ensure_image(
+                artifact['image_name'],
+                url,
+                IMAGES_ROOT,
+                artifact.get('image_md5'),
+                image_folder if extract else None,
+                self.log,
+                rate=rate,
+                verify=True,
+            )
 
     def get_proc_lxc_tmpl_ctx(self):
         proc_path = get_container_path(self.config)
@@ -116,37 +199,26 @@ class ImageRunner(BaseRunner):
     def ensure_char_devices(self):
         for path_, devnums, perms in self.char_devices:
             fullpath = get_container_path(self.config) + path_
-            ensure_char_device(fullpath, devnums, perms)
+            ensure_char_device(fullpath, devnums, perms, self.log)
 
 
-def ensure_char_device(path, devnums, perms):
+def ensure_char_device(path, devnums, perms, log=print):
     # Python uses the OS mknod(2) implementation which modifies the mode based
     # on the umask of the running process (at least on some Linuxes that were
-    # tested).  Set this to 0 to make mknod apply the perms you actually
-    # specify
-    print("Making device nodes")
+    # tested).  Rather than setting the umask to 0, which would affect files
+    # created by setup steps running concurrently, chmod the node afterwards
+    # to apply the perms you actually specify.
+    log("Making device nodes")
     if not os.path.exists(path):
-        with tmp_umask(0):
-            print(
-                "mknod -m %o %s c %s %s"
-                % (perms, path, devnums[0], devnums[1]))
-            mkdir(os.path.dirname(path))
-            mode = (stat.S_IFCHR | perms)
-            os.mknod(path, mode, os.makedev(*devnums))
+        log(
+            "mknod -m %o %s c %s %s"
+            % (perms, path, devnums[0], devnums[1]))
+        mkdir(os.path.dirname(path))
+        mode = (stat.S_IFCHR | perms)
+        os.mknod(path, mode, os.makedev(*devnums))
+        os.chmod(path, perms)
     else:
-        print("%s already exists.  Skipping" % path)
-
-
-class tmp_umask(object):
-    """Context manager for temporarily setting the process umask"""
-    def __init__(self, tmp_mask):
-        self.tmp_mask = tmp_mask
-
-    def __enter__(self):
-        self.orig_mask = os.umask(self.tmp_mask)
-
-    def __exit__(self, type, value, traceback):
-        os.umask(self.orig_mask)
+        log("%s already exists.  Skipping" % path)
 
 
 if __name__ == '__main__':
@@ -6,15 +6,34 @@
 export TMPDIR=%(tmp)s
 export HOME=%(home)s
 
-# scripts in .profile.d may come from the app or from the buildpack.
-if (test -d $HOME/.profile.d); then
-	for f in `ls $HOME/.profile.d`; do
-		source $HOME/.profile.d/$f
-	done
+# Called once by setup to capture the environment built below.  Record what
+# it looks like beforehand, so setup can tell which variables were set here.
+if [ "dumpenv" == "$1" ]
+then
+  env -0 > %(rawenv)s.before
+fi
+
+if [ "dumpenv" != "$1" ] && [ -f %(procenv)s ]; then
+	# The result of the .profile.d scripts and env.sh was flattened into
+	# this file at setup time, so we don't have to evaluate them again.
+	source %(procenv)s
+else
+	# scripts in .profile.d may come from the app or from the buildpack.
+	if (test -d $HOME/.profile.d); then
+		for f in `ls $HOME/.profile.d`; do
+			source $HOME/.profile.d/$f
+		done
+	fi
+
+	# These env vars are from release-specific config.
+	source %(envsh)s
+fi
+
+if [ "dumpenv" == "$1" ]
+then
+  exec env -0 > %(rawenv)s
 fi
 
-# These env vars are from release-specific config.
-source %(envsh)s
 export APP_SETTINGS_YAML="%(settings)s"
 
 # We control the port.  Don't allow env.sh or .profile.d to override it.